@@ -1,139 +1,326 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import hashlib
 import json
 import os
+import re
 import subprocess
-from typing import List, Dict
-import yaml
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address
+from typing import Any, List, Dict, Optional, Set, Tuple
 import socket
 
+DEFAULT_MOUNT_OPTS = "rsize=1048576,wsize=1048576,actimeo=600,nolock,hard,proto=tcp"
+
+# Added to the default mount options on kernels that support it (5.3+)
+NCONNECT_MOUNT_OPT = "nconnect=8"
+
+@functools.lru_cache(maxsize=1)
+def _hostname() -> str:
+    """Get this machine's hostname, which doesn't change during a run."""
+    return socket.gethostname()
+
+def _kernel_version() -> Tuple[int, int]:
+    """Get the running kernel's (major, minor) version, or (0, 0) if it can't be parsed."""
+    release = os.uname().release
+    try:
+        major, minor = (int(part) for part in release.split("-")[0].split(".")[:2])
+    except ValueError:
+        return (0, 0)
+    return (major, minor)
+
+def default_mount_opts() -> str:
+    """Get the default NFS mount options, adding nconnect where the kernel accepts it."""
+    if _kernel_version() >= (5, 3):
+        return f"{DEFAULT_MOUNT_OPTS},{NCONNECT_MOUNT_OPT}"
+    return DEFAULT_MOUNT_OPTS
+
+def _unescape_mountinfo(field: str) -> str:
+    """Decode the octal escapes (e.g. \\040 for space) used in /proc/self/mountinfo."""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+def _mounted_set() -> Set[str]:
+    """Read the set of active mount points from /proc/self/mountinfo in one pass."""
+    with open("/proc/self/mountinfo") as f:
+        return {_unescape_mountinfo(line.split(" ")[4]) for line in f}
+
 class FioBalancer:
-    def __init__(self, hosts: List[str], ip_addresses: List[str], mount_base: str = "/mnt", total_threads: int = 8192):
+    # Each host owns a contiguous block of IPs, one per share (mount1 through mount8)
+    IPS_PER_HOST = 8
+
+    # FIO phases in the order they run, with the fio rw mode for each
+    FIO_PHASES = (("write", "randwrite"), ("read", "randread"))
+
+    # memfd-backed FIO configs, keyed by content digest, kept for the life of the process
+    _config_fds: Dict[str, int] = {}
+
+    def __init__(self, hosts: List[str], ip_addresses: List[str], mount_base: str = "/mnt", total_threads: int = 8192,
+                 mount_opts: Optional[str] = None, sequential_phases: bool = False):
+        if len(ip_addresses) != self.IPS_PER_HOST * len(hosts):
+            raise ValueError(
+                f"Expected {self.IPS_PER_HOST} IP addresses per host "
+                f"({self.IPS_PER_HOST * len(hosts)} for {len(hosts)} hosts), got {len(ip_addresses)}"
+            )
+        # Reject malformed addresses before anything is mounted; only IPv4 is
+        # supported, since the mount source is built as <ip>:/<share>
+        invalid_ips = []
+        for ip in ip_addresses:
+            # IPv4Address also accepts integers, which would break path and mount source building
+            if not isinstance(ip, str):
+                invalid_ips.append(repr(ip))
+                continue
+            try:
+                IPv4Address(ip)
+            except ValueError:
+                invalid_ips.append(ip)
+        if invalid_ips:
+            raise ValueError(f"Invalid IPv4 addresses: {', '.join(invalid_ips)}")
+        # A repeated hostname would make the host's IP block ambiguous
+        seen_hosts = set()
+        duplicate_hosts = []
+        for host in hosts:
+            if host in seen_hosts and host not in duplicate_hosts:
+                duplicate_hosts.append(host)
+            seen_hosts.add(host)
+        if duplicate_hosts:
+            raise ValueError(f"Duplicate hostnames in host list: {', '.join(duplicate_hosts)}")
+
         self.hosts = hosts
+        self._host_index = {host: i for i, host in enumerate(hosts)}
         self.ip_addresses = ip_addresses
         self.mount_base = mount_base
-        self.shares = [f"mount{i}" for i in range(1, 9)]
+        self.mount_opts = default_mount_opts() if mount_opts is None else mount_opts
+        self.shares = [f"mount{i}" for i in range(1, self.IPS_PER_HOST + 1)]
         self.mounted_points = set()
+        self._mounted_lock = threading.Lock()
         
         # Get current hostname
-        self.current_host = socket.gethostname()
+        self.current_host = _hostname()
         
         # Calculate which IPs belong to this host
         self.host_ips = self._get_host_ips()
 
+        # Each IP uses the corresponding share (mount1 through mount8)
+        self.host_share_pairs = tuple(zip(self.host_ips, self.shares))
+        # mountinfo records canonical paths, so resolve mount_base once here; the
+        # mount points themselves are never stat'ed, which could hang on a dead NFS server
+        real_mount_base = os.path.realpath(self.mount_base)
+        self.host_mount_points = tuple(os.path.join(real_mount_base, ip) for ip in self.host_ips)
+
         self.total_threads = total_threads
+        self.sequential_phases = sequential_phases
+
+        # The [global] section is identical for every IP, so build it once
+        self._config_template = self._build_fio_config_template()
 
     def _get_host_ips(self) -> List[str]:
         """Get the IPs that belong to the current host."""
-        # Calculate how many IPs per host (8)
-        ips_per_host = 8
-        
         # Find this host's index
-        try:
-            host_index = self.hosts.index(self.current_host)
-        except ValueError:
-            print(f"Error: Current host {self.current_host} not found in host list")
-            return []
+        host_index = self._host_index.get(self.current_host)
+        if host_index is None:
+            raise KeyError(f"Current host {self.current_host} not found in host list")
         
         # Get the IPs for this host
-        start_idx = host_index * ips_per_host
-        return self.ip_addresses[start_idx:start_idx + ips_per_host]
+        start_idx = host_index * self.IPS_PER_HOST
+        return self.ip_addresses[start_idx:start_idx + self.IPS_PER_HOST]
 
-    def _mount_point(self, ip: str, share: str) -> bool:
+    def _mount_point(self, ip: str, share: str, mount_point: str, mounts: Set[str]) -> bool:
         """Mount a single IP address with a specific share."""
-        mount_point = os.path.join(self.mount_base, ip)
-        
         # Create mount point if it doesn't exist
         os.makedirs(mount_point, exist_ok=True)
         
         # Check if already mounted
-        if os.path.ismount(mount_point):
+        if mount_point in mounts:
             print(f"Mount point {mount_point} is already mounted")
-            self.mounted_points.add(mount_point)  # Add to set even if already mounted
+            with self._mounted_lock:
+                self.mounted_points.add(mount_point)  # Add to set even if already mounted
             return True
             
         # Mount the IP with specific share
-        cmd = f"mount -t nfs {ip}:/{share} {mount_point}"
         try:
-            subprocess.run(cmd, shell=True, check=True)
-            self.mounted_points.add(mount_point)
+            cmd = ["mount", "-t", "nfs"]
+            if self.mount_opts:
+                cmd += ["-o", self.mount_opts]
+            subprocess.run(cmd + [f"{ip}:/{share}", mount_point], check=True)
+            with self._mounted_lock:
+                self.mounted_points.add(mount_point)
             print(f"Successfully mounted {ip}:/{share} at {mount_point}")
             return True
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
             print(f"Error mounting {ip}:/{share} at {mount_point}: {e}")
             return False
 
-    def _unmount_point(self, mount_point: str) -> bool:
+    def _unmount_point(self, mount_point: str, mounts: Set[str]) -> bool:
         """Unmount a single mount point."""
-        if not os.path.ismount(mount_point):
+        if mount_point not in mounts:
             print(f"Mount point {mount_point} is not mounted")
-            if mount_point in self.mounted_points:
-                self.mounted_points.remove(mount_point)
+            with self._mounted_lock:
+                self.mounted_points.discard(mount_point)
             return True
             
         try:
-            subprocess.run(f"umount {mount_point}", shell=True, check=True)
-            if mount_point in self.mounted_points:
-                self.mounted_points.remove(mount_point)
+            subprocess.run(["umount", mount_point], check=True)
+            with self._mounted_lock:
+                self.mounted_points.discard(mount_point)
             print(f"Successfully unmounted {mount_point}")
             return True
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
             print(f"Error unmounting {mount_point}: {e}")
             return False
 
     def _mount_all(self) -> bool:
         """Mount all IPs for this host."""
-        success = True
-        for i, ip in enumerate(self.host_ips):
-            # Use the corresponding share for this IP (mount1 through mount8)
-            share = self.shares[i]
-            if not self._mount_point(ip, share):
-                success = False
-        return success
+        # Snapshot the mount table once rather than stat'ing every mount point
+        mounts = _mounted_set()
+        # The MOUNT RPCs are independent, so issue them in parallel
+        with ThreadPoolExecutor(max_workers=len(self.host_ips)) as executor:
+            results = list(executor.map(
+                lambda pair, mount_point: self._mount_point(*pair, mount_point, mounts),
+                self.host_share_pairs, self.host_mount_points,
+            ))
+        return all(results)
 
     def _unmount_all(self) -> bool:
-        """Unmount all IPs for this host."""
-        success = True
-        for ip in self.host_ips:
-            mount_point = os.path.join(self.mount_base, ip)
-            if not self._unmount_point(mount_point):
-                success = False
-        return success
-
-    def _generate_fio_config(self, mount_point: str) -> str:
-        """Generate FIO configuration for a specific mount point."""
-        # Create the output directory structure
-        output_dir = os.path.join(mount_point, "fio", self.current_host)
-        os.makedirs(output_dir, exist_ok=True)
+        """Unmount all points this host successfully mounted."""
+        # Only points that mounted need tearing down; failed mounts are skipped
+        with self._mounted_lock:
+            mount_points = list(self.mounted_points)
+        if not mount_points:
+            return True
+        mounts = _mounted_set()
+        with ThreadPoolExecutor(max_workers=len(mount_points)) as executor:
+            results = list(executor.map(
+                lambda mount_point: self._unmount_point(mount_point, mounts),
+                mount_points,
+            ))
+        return all(results)
 
-        # Use the total_threads parameter directly
-        threads_per_mount = self.total_threads
+    def _build_fio_config_template(self) -> str:
+        """Build the [global] section shared by every FIO job."""
+        # numjobs applies to every section, so split total_threads across the
+        # sections that run at the same time (each IP, times overlapping phases)
+        concurrent_phases = 1 if self.sequential_phases else len(self.FIO_PHASES)
+        concurrent_sections = len(self.host_ips) * concurrent_phases
+        threads_per_section = max(1, self.total_threads // concurrent_sections)
+
+        # io_uring (5.6+) avoids libaio's per-submit overhead; fall back on older kernels
+        if _kernel_version() >= (5, 6):
+            engine_options = """ioengine=io_uring
+fixedbufs=1
+registerfiles=1
+sqthread_poll=0
+hipri=0"""
+        else:
+            engine_options = "ioengine=libaio"
 
         # Generate INI format configuration
         config = f"""[global]
-ioengine=libaio
+{engine_options}
 direct=1
 size=1g
 runtime=60
 time_based=1
 group_reporting=1
 numa_mem_policy=local
-numjobs={threads_per_mount}
+numjobs={threads_per_section}
 iodepth=16
 bs=2m
-
-[read]
-rw=randread
-directory={output_dir}
-
-[write]
-rw=randwrite
-directory={output_dir}
 """
         return config
 
-    def run(self):
+    def _output_dir(self, mount_point: str, phase: str) -> str:
+        """Get the FIO output directory for this host and phase on a mount point."""
+        output_dir = os.path.join(mount_point, "fio", self.current_host)
+        if self.sequential_phases:
+            # Phases take turns, so the read test reuses the files the write test laid out
+            return output_dir
+        # Concurrent phases each get their own directory so they don't stomp on each other
+        return os.path.join(output_dir, phase)
+
+    def _make_output_dir(self, output_dir: str) -> None:
+        """Create an FIO output directory, skipping the create if it already exists."""
+        # A single stat is cheaper over NFS than makedirs walking every component
+        try:
+            os.stat(output_dir)
+        except FileNotFoundError:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def _cpu_sets(self) -> List[List[int]]:
+        """Split the CPUs this process may run on into one disjoint set per IP."""
+        cpus = sorted(os.sched_getaffinity(0))
+        num_ips = len(self.host_ips)
+        if len(cpus) < num_ips:
+            # Fewer CPUs than IPs: give each IP a single CPU, shared round-robin
+            return [[cpus[i % len(cpus)]] for i in range(num_ips)]
+        # Contiguous slices, with any remainder spread over the first IPs
+        per_ip, extra = divmod(len(cpus), num_ips)
+        cpu_sets = []
+        start = 0
+        for i in range(num_ips):
+            end = start + per_ip + (1 if i < extra else 0)
+            cpu_sets.append(cpus[start:end])
+            start = end
+        return cpu_sets
+
+    def _generate_fio_config(self, output_dirs: Dict[str, List[str]]) -> str:
+        """Generate one FIO configuration with a write and read section per IP."""
+        sections = [self._config_template]
+        cpu_sets = self._cpu_sets()
+        for i, (ip, cpu_set) in enumerate(zip(self.host_ips, cpu_sets)):
+            # Pin each IP's jobs to its own CPUs so they don't migrate between cores;
+            # new_group keeps a separate group_reporting summary per IP
+            cpus_allowed = ",".join(str(cpu) for cpu in cpu_set)
+            for phase, rw in self.FIO_PHASES:
+                sections.append(f"""
+[{phase}-{ip}]
+new_group
+rw={rw}
+directory={output_dirs[phase][i]}
+cpus_allowed={cpus_allowed}
+cpus_allowed_policy=split
+""")
+        return "".join(sections)
+
+    def _config_fd(self, config: str) -> int:
+        """Get an in-memory file holding the FIO config, writing it only if not cached."""
+        digest = hashlib.blake2b(config.encode()).hexdigest()
+        fd = self._config_fds.get(digest)
+        if fd is None:
+            # An anonymous memfd leaves no dentry in /tmp to create or delete
+            fd = os.memfd_create("fio_cfg")
+            os.write(fd, config.encode())
+            self._config_fds[digest] = fd
+        return fd
+
+    async def _run_fio_phase(self, phase: str, config_fd: int) -> bool:
+        """Run one FIO phase for every IP of this host in a single fio process."""
+        section_args = [f"--section={phase}-{ip}" for ip in self.host_ips]
+        # Send fio's output straight to a log file so the OS writes it
+        # without a Python read loop or contention on the terminal
+        log_file = f"/tmp/fio_{self.current_host}_{phase}.log"
+        # fio inherits the memfd under the same number and opens it by path
+        config_file = f"/proc/self/fd/{config_fd}"
+        try:
+            with open(log_file, 'wb') as log:
+                proc = await asyncio.create_subprocess_exec(
+                    "fio", *section_args, config_file,
+                    stdout=log, stderr=asyncio.subprocess.STDOUT, pass_fds=(config_fd,),
+                )
+                returncode = await proc.wait()
+        except OSError as e:
+            print(f"Error running FIO {phase} test on {self.current_host}: {e}")
+            return False
+        if returncode != 0:
+            print(f"Error running FIO {phase} test on {self.current_host}: exit status {returncode} (see {log_file})")
+            return False
+        print(f"FIO {phase} test output written to {log_file}")
+        return True
+
+    async def run_async(self):
         """Run FIO tests for this host's IPs."""
         print(f"Running on host {self.current_host}")
         print(f"Assigned IPs: {self.host_ips}")
@@ -141,39 +328,63 @@ directory={output_dir}
         # Mount all IPs for this host
         if not self._mount_all():
             print(f"Failed to mount all IPs for {self.current_host}")
+            # Release whichever points did mount
+            self._unmount_all()
             return
 
         try:
-            for ip in self.host_ips:
-                mount_point = os.path.join(self.mount_base, ip)
-                config = self._generate_fio_config(mount_point)
-                
-                # Create config file
-                config_file = f"/tmp/fio_config_{ip}.ini"
-                with open(config_file, 'w') as f:
-                    f.write(config)
-                
-                # Run FIO write test first
-                write_cmd = f"fio --section=write {config_file}"
-                try:
-                    print("\nRunning write test...")
-                    subprocess.run(write_cmd, shell=True, check=True)
-                except subprocess.CalledProcessError as e:
-                    print(f"Error running FIO write test on {self.current_host} for {ip}: {e}")
-                
-                # Then run FIO read test
-                read_cmd = f"fio --section=read {config_file}"
-                try:
-                    print("\nRunning read test...")
-                    subprocess.run(read_cmd, shell=True, check=True)
-                except subprocess.CalledProcessError as e:
-                    print(f"Error running FIO read test on {self.current_host} for {ip}: {e}")
-                finally:
-                    os.remove(config_file)
+            # Create the output directory structure
+            output_dirs = {
+                phase: [self._output_dir(mount_point, phase) for mount_point in self.host_mount_points]
+                for phase, _ in self.FIO_PHASES
+            }
+            unique_dirs = {d for dirs in output_dirs.values() for d in dirs}
+            with ThreadPoolExecutor(max_workers=len(unique_dirs)) as executor:
+                list(executor.map(self._make_output_dir, unique_dirs))
+
+            # Create a single config covering all IPs; fio drives the
+            # per-IP jobs of a phase concurrently from one process
+            config_fd = self._config_fd(self._generate_fio_config(output_dirs))
+
+            if self.sequential_phases:
+                # Run FIO write test first, then the read test
+                for phase, _ in self.FIO_PHASES:
+                    print(f"\nRunning {phase} test...")
+                    await self._run_fio_phase(phase, config_fd)
+            else:
+                # Overlap the write and read tests so the server can service both at once
+                print(f"\nRunning {' and '.join(phase for phase, _ in self.FIO_PHASES)} tests concurrently...")
+                # Each phase reports its own failure, so both finish before unmounting
+                await asyncio.gather(*(self._run_fio_phase(phase, config_fd) for phase, _ in self.FIO_PHASES))
         finally:
             # Unmount all IPs for this host
             self._unmount_all()
 
+    def run(self):
+        """Run FIO tests for this host's IPs."""
+        asyncio.run(self.run_async())
+
+def load_config(path: str) -> Dict[str, Any]:
+    """Load a YAML or JSON (by .json suffix) configuration file."""
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON in config file: {e}")
+
+    # Import yaml lazily so JSON configs and CLI-only runs skip its import cost
+    import yaml
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+    with open(path, 'r') as f:
+        try:
+            return yaml.load(f, Loader=Loader)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid YAML in config file: {e}")
+
 def main():
     parser = argparse.ArgumentParser(
         description='Run FIO tests on this host',
@@ -181,7 +392,8 @@ def main():
         epilog="""
 Example usage:
   # Using command line arguments:
-  python3 fio_balancer.py --hosts host1 host2 --ips 10.0.2.64 10.0.2.65 --total-threads 1
+  python3 fio_balancer.py --hosts host1 --ips 10.0.2.64 10.0.2.65 10.0.2.66 10.0.2.67 \\
+      10.0.2.68 10.0.2.69 10.0.2.70 10.0.2.71 --total-threads 1
 
   # Using config file:
   python3 fio_balancer.py --config config.yaml
@@ -190,23 +402,28 @@ Example usage:
     parser.add_argument('--hosts', nargs='+', help='List of all hostnames')
     parser.add_argument('--ips', nargs='+', help='List of all IP addresses')
     parser.add_argument('--mount-base', default='/mnt', help='Base mount point directory')
+    parser.add_argument('--mount-opts',
+                        help=f'NFS mount options passed to mount -o; overrides mount_opts in the config file '
+                             f'(default: {DEFAULT_MOUNT_OPTS}, plus {NCONNECT_MOUNT_OPT} on kernels 5.3+)')
     parser.add_argument('--total-threads', type=int, default=8192, help='Total number of threads to distribute (default: 8192)')
-    parser.add_argument('--config', help='YAML configuration file (alternative to command line arguments)')
+    parser.add_argument('--sequential-phases', action='store_true',
+                        help='Run the write test to completion before the read test instead of overlapping them')
+    parser.add_argument('--config', help='YAML or JSON configuration file (alternative to command line arguments)')
     
     args = parser.parse_args()
     
     if args.config:
         try:
-            with open(args.config, 'r') as f:
-                config = yaml.safe_load(f)
-                hosts = config['hosts']
-                ips = config['ip_addresses']
-                mount_base = config.get('mount_base', '/mnt')
+            config = load_config(args.config)
+            hosts = config['hosts']
+            ips = config['ip_addresses']
+            mount_base = config.get('mount_base', '/mnt')
+            mount_opts = config.get('mount_opts')
         except FileNotFoundError:
             print(f"Error: Config file '{args.config}' not found")
             return
-        except yaml.YAMLError as e:
-            print(f"Error: Invalid YAML in config file: {e}")
+        except ValueError as e:
+            print(f"Error: {e}")
             return
         except KeyError as e:
             print(f"Error: Missing required field '{e}' in config file")
@@ -219,13 +436,24 @@ Example usage:
         hosts = args.hosts
         ips = args.ips
         mount_base = args.mount_base
+        mount_opts = None
 
-    balancer = FioBalancer(
-        hosts=hosts,
-        ip_addresses=ips,
-        mount_base=mount_base,
-        total_threads=args.total_threads
-    )
+    # An explicit --mount-opts wins over the config file; FioBalancer falls back to the default
+    if args.mount_opts is not None:
+        mount_opts = args.mount_opts
+
+    try:
+        balancer = FioBalancer(
+            hosts=hosts,
+            ip_addresses=ips,
+            mount_base=mount_base,
+            mount_opts=mount_opts,
+            total_threads=args.total_threads,
+            sequential_phases=args.sequential_phases
+        )
+    except (KeyError, ValueError) as e:
+        print(f"Error: {e.args[0]}")
+        return
     balancer.run()
 
 if __name__ == '__main__':